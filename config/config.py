@@ -1,11 +1,33 @@
+import atexit
 import json
+import os
+import threading
+
+try:  # Use orjson's C parser if it is installed, otherwise fall back on the standard library
+    import orjson
+
+    def _parse(json_file) -> dict:
+        return orjson.loads(json_file.read())
+
+    def _serialize(values: dict) -> str:
+        return orjson.dumps(values, option=orjson.OPT_INDENT_2).decode()
+except ModuleNotFoundError:
+    def _parse(json_file) -> dict:
+        return json.load(json_file)
+
+    def _serialize(values: dict) -> str:
+        return json.dumps(values, indent=2)
 
 
 class Config:
+    __slots__ = ("autosave", "autosave_delay_ms", "file_loc", "required_keys", "values",
+                 "_file_snapshot", "_file_mtime", "_dirty", "_save_timer", "_save_lock")
+
     def __init__(self, file_loc: str,
                  required_keys: dict = None,
                  autosave: bool = False,
-                 delay_load: bool = False):
+                 delay_load: bool = False,
+                 autosave_delay_ms: int = 250):
         """
         Creates a Config object and loads the values in from the provided file path
 
@@ -19,11 +41,20 @@ class Config:
             updating a value
         :param delay_load: Set to `True` to prevent the constructor from loading the
             config file
+        :param autosave_delay_ms: How long autosave waits after a value is updated before
+            saving. Any updates within that time are saved together. If `0`, the file is
+            saved immediately after every update
         """
         self.autosave = autosave
+        self.autosave_delay_ms = autosave_delay_ms
         self.file_loc = file_loc
         self.required_keys = required_keys if required_keys is not None else {}
         self.values = {}
+        self._file_snapshot = {}  # The last parsed contents of the config file
+        self._file_mtime = None   # The modification time of the file when it was last parsed
+        self._dirty = False       # Whether values were updated since the last autosave
+        self._save_timer = None   # The timer for the pending autosave
+        self._save_lock = threading.RLock()  # Held while the file is written, so saves never overlap
         if not delay_load:
             self.reload()
 
@@ -61,6 +92,21 @@ class Config:
                 raise ValueError(f"Found non-type value `{value}` for the key `{key}`")
         self.required_keys = keys
 
+    def _read_file(self) -> dict:
+        """
+        Returns the parsed contents of the configuration file. The file is only
+        parsed again if it has been modified since the last time it was read
+
+        :return: The dictionary stored in the configuration file. This is the
+            cached copy, so it should not be modified
+        """
+        mtime = os.stat(self.file_loc).st_mtime_ns
+        if mtime != self._file_mtime:  # Re-parse the file only if it changed on disk
+            with open(self.file_loc) as json_file:
+                self._file_snapshot = _parse(json_file)
+            self._file_mtime = mtime
+        return self._file_snapshot
+
     def reload(self, required_keys: dict = None) -> None:
         """
         Reads in configuration values from file. Any existing configuration
@@ -77,19 +123,18 @@ class Config:
         if required_keys is None:
             required_keys = self.required_keys
 
-        with open(self.file_loc) as json_file:
-            new_values = json.load(json_file)
+        new_values = dict(self._read_file())
 
         for (key, expected_type) in required_keys.items():  # Check to make sure all required keys are present
             if expected_type is not None:  # Ignore type check if type is `None`
                 if key not in new_values:  # Raise error if key could not be found
                     raise RuntimeError(f"Missing required configuration key: `{key}` ({expected_type.__name__})")
-                else:
+                elif not isinstance(new_values[key], expected_type):  # Skip the cast if already correct
                     try:  # Cast value to required type
                         new_values[key] = expected_type(new_values[key])
                     except Exception as exc:  # If cast fails for any reason, raise a TypeError
                         raise TypeError(f"Failed to cast the value of key `{key}` "
-                                        f"from {new_values[key].__name__} to {expected_type.__name__}\n{exc}")
+                                        f"from {type(new_values[key]).__name__} to {expected_type.__name__}\n{exc}")
         self.values.update(new_values)
 
     def save(self, all_values: bool = True) -> None:
@@ -100,21 +145,23 @@ class Config:
                 If `False`, only the keys present in the target file will be overwritten
         """
 
-        """ Read values in target file """
-        with open(self.file_loc) as json_file:
-            file_values = json.load(json_file)
+        with self._save_lock:
+            """ Read values in target file """
+            file_values = dict(self._read_file())
 
-        """ Update dictionary files """
-        if all_values:  # Copy all values
-            file_values.update(self.values)
-        else:           # Only update keys present in target file
-            for key in self.values:     # Check all configuration keys
-                if key in file_values:  # Update if key is in file
-                    file_values[key] = self.values[key]
+            """ Update dictionary files """
+            if all_values:  # Copy all values
+                file_values.update(self.values)
+            else:           # Only update keys present in target file
+                for key in self.values:     # Check all configuration keys
+                    if key in file_values:  # Update if key is in file
+                        file_values[key] = self.values[key]
 
-        """ Save updated dictionary to file """
-        with open(self.file_loc, 'w') as json_file:
-            json.dump(file_values, json_file, indent=2)
+            """ Save updated dictionary to file """
+            with open(self.file_loc, 'w') as json_file:
+                json_file.write(_serialize(file_values))
+            self._file_snapshot = file_values
+            self._file_mtime = os.stat(self.file_loc).st_mtime_ns
 
     def set_value(self, key: str, value) -> None:
         """
@@ -135,5 +182,39 @@ class Config:
                                 f"{self.required_keys[key].__name__}\n{exc}")
         self.values[key] = value
         if self.autosave:
+            self._schedule_save()
+
+    def flush(self) -> None:
+        """
+        Immediately saves any values updated since the last autosave, rather than
+        waiting for the autosave delay to pass
+        """
+        with self._save_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if self._dirty:
+                self._dirty = False
+                self.save(all_values=False)
+            # Only unregistered once the file is written, so a save still running on the timer's
+            # thread when the program exits is waited for instead of being cut off mid-write
+            atexit.unregister(self.flush)
+
+    def _schedule_save(self) -> None:
+        """
+        Schedules an autosave once `autosave_delay_ms` has passed. If a save is already
+        pending, it is postponed, so a burst of updates only writes the file once
+        """
+        if self.autosave_delay_ms <= 0:
             self.save(all_values=False)
+            return
+        with self._save_lock:
+            self._dirty = True
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+            else:  # Make sure pending values are saved if the program exits first
+                atexit.register(self.flush)
+            self._save_timer = threading.Timer(self.autosave_delay_ms / 1000, self.flush)
+            self._save_timer.daemon = True
+            self._save_timer.start()
 
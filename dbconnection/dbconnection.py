@@ -1,44 +1,268 @@
+from contextlib import contextmanager
+from datetime import datetime
+import functools
 import os
-from typing import Optional
-import mysql.connector
-import mysql.connector.cursor as mysql_cursor
+import queue
+import threading
+import weakref
+from typing import TYPE_CHECKING, Iterator, Optional
 from config import Config
 
-_cnx = None
-_last_id = None
+if TYPE_CHECKING:
+    import mysql.connector.connection as mysql_connection
+    import mysql.connector.cursor as mysql_cursor
+
+_mysql = None  # The mysql.connector module. Imported on first use by `_get_mysql()`
+_POOL_SIZE = 4                          # The maximum number of idle connections kept open for reuse
+_idle_connections = queue.LifoQueue()   # The open connections not currently borrowed by a thread
+_prepared_cursors = weakref.WeakKeyDictionary()  # Each connection's prepared cursors, keyed by statement
+_last_image = None  # The row for the image most recently logged by this process, if it is still in the table
+
+_LOG_IMAGE_STATEMENT = ("INSERT INTO images (link_id, loop_count, left_camera, passed, filepath, time) "
+                        "VALUES (%s, %s, %s, %s, %s, %s)")
+# The statements of `trim_images()`. Each table is trimmed by first finding the newest image that
+# falls outside the limit, then removing that image and everything older than it
+_RECENT_CUTOFF_STATEMENT = "SELECT img_id FROM images WHERE link_id = %s ORDER BY img_id DESC LIMIT 1 OFFSET %s"
+_FAILURE_CUTOFF_STATEMENT = ("SELECT img_id FROM past_failures WHERE link_id = %s "
+                             "ORDER BY img_id DESC LIMIT 1 OFFSET %s")
+_TRANSFER_STATEMENT = ("INSERT INTO past_failures "
+                       "SELECT * FROM images WHERE link_id = %s AND NOT passed AND img_id <= %s")
+_REMOVE_IMAGES_STATEMENT = "DELETE FROM images WHERE link_id = %s AND img_id <= %s"
+_REMOVE_FAILURES_STATEMENT = "DELETE FROM past_failures WHERE link_id = %s AND img_id <= %s"
+# The statements of the config table functions
+_GET_ATTRIBUTE_STATEMENT = "SELECT value FROM config WHERE attribute = %s"
+_UPDATE_ATTRIBUTE_STATEMENT = "UPDATE config SET value = %s WHERE attribute = %s"
+_UPSERT_ATTRIBUTE_STATEMENT = ("INSERT INTO config (attribute, value) VALUES (%s, %s) "
+                               "ON DUPLICATE KEY UPDATE value = VALUES(value)")
+_batch_size = 1              # The number of images buffered by `log_image()` before they are inserted
+_batch_interval_ms = 0       # The longest an image may wait in the buffer before it is inserted
+_image_buffer = []           # The images waiting to be inserted
+_image_buffer_lock = threading.Lock()
+_flush_lock = threading.Lock()  # Held while buffered images are inserted, so flushes wait for each other
+_flush_timer = None          # The timer which flushes the buffer once `_batch_interval_ms` has passed
 _CONFIG_FILE = "config.json"              # The name of the module's configuration file
 _MODULE_DIR = os.path.split(__file__)[0]  # The directory of this module
-_CONFIG = Config(f"{_MODULE_DIR}/{_CONFIG_FILE}")
+_CONFIG = None                            # The configuration object. Loaded on first use by `_get_config()`
 
 
-def connect() -> mysql_cursor:
+def _get_config() -> Config:
     """
-    Establishes a connection with the database and returns a cursor
+    Returns the module's configuration, loading it from file the first time it is needed
+
+    :return: The Config object for this module
+    """
+    global _CONFIG
+    if _CONFIG is None:
+        _CONFIG = Config(f"{_MODULE_DIR}/{_CONFIG_FILE}")
+    return _CONFIG
+
+
+def _get_mysql():
+    """
+    Returns the mysql.connector module, importing it the first time it is needed.
+    This keeps the cost of loading the connector out of the import of this module
+
+    :return: The mysql.connector module
+    """
+    global _mysql
+    if _mysql is None:
+        import mysql.connector
+        _mysql = mysql.connector
+    return _mysql
+
+
+def _open_connection() -> "mysql_connection":
+    """
+    Opens a new connection to the database using the credentials in the config file
+
+    :raises: mysql.connector.Error if there is a failure to connect
+    :return: The new connection
+    """
+    config = _get_config()
+    return _get_mysql().connect(user=config['MYSQL_USERNAME'],
+                                password=config['MYSQL_PASSWORD'],
+                                host=config['MYSQL_HOST'],
+                                database=config['MYSQL_DATABASE'],
+                                autocommit=True)
+
+
+@contextmanager
+def connect() -> Iterator["mysql_connection"]:
+    """
+    Borrows a connection to the database for the duration of a `with` block. Idle
+    connections are reused when available, otherwise a new one is opened. Once the
+    block exits, the connection is returned to the pool so later calls can reuse it
+    instead of connecting again. If the block raises an exception, the connection is
+    closed instead, which also rolls back any open transaction. If the connection was
+    lost, the other idle connections are closed as well, since they were most likely lost too
 
     :raises: mysql.connector.Error if there is a failure to connect
-    :return: A cursor for the database. 'None' if failed to connect
+    :return: A connection to the database
+    """
+    try:
+        cnx = _idle_connections.get_nowait()
+    except queue.Empty:  # Open a new connection if all of them are in use
+        cnx = _open_connection()
+    try:
+        yield cnx
+    except BaseException as exc:
+        _discard_connection(cnx)
+        # The connection isn't checked before it is lent out, so it may turn out to have been lost
+        if isinstance(exc, _get_mysql().Error) and _connection_lost(exc):
+            print("Lost the database connection. Closing the idle connections...")
+            _close_idle_connections()
+        raise
+    if _is_closed(cnx) or _idle_connections.qsize() >= _POOL_SIZE:
+        _discard_connection(cnx)
+    else:  # Keep the connection open for reuse
+        _idle_connections.put(cnx)
+
+
+def _is_closed(cnx: "mysql_connection") -> bool:
+    """
+    Checks whether a connection has been closed. The C extension answers this without
+    contacting the server, while the pure Python connector has to ping it
+
+    :param cnx: The connection to check
+    :return: `True` if the connection is closed
+    """
+    if hasattr(cnx, 'is_closed'):
+        return cnx.is_closed()
+    return not cnx.is_connected()
+
+
+def _discard_connection(cnx: "mysql_connection") -> None:
+    """
+    Closes a connection which won't be returned to the pool, along with its prepared cursors
+
+    :param cnx: The connection to close
+    """
+    _prepared_cursors.pop(cnx, None)
+    try:
+        cnx.close()
+    except _get_mysql().Error:  # The connection was already lost
+        pass
+
+
+def _close_idle_connections() -> None:
+    """
+    Closes every connection in the pool which isn't currently borrowed
+    """
+    while True:
+        try:
+            cnx = _idle_connections.get_nowait()
+        except queue.Empty:
+            return
+        _discard_connection(cnx)
+
+
+def _connection_lost(exc: Exception) -> bool:
+    """
+    Checks whether an error raised by the connector means the connection was lost
+
+    :param exc: The connector's error
+    :return: `True` if the connection was lost
+    """
+    mysql = _get_mysql()
+    return isinstance(exc, (mysql.InterfaceError, mysql.OperationalError)) or _statement_unsent(exc)
+
+
+def _statement_unsent(exc: Exception) -> bool:
+    """
+    Checks whether an error raised by the connector means the connection was lost before
+    the statement reached the server, which is the case when the statement couldn't be
+    written to the connection, or the server had already closed it for being idle too long.
+    Other lost connection errors may happen after the server has run the statement
+
+    :param exc: The connector's error
+    :return: `True` if the statement was not run by the server
+    """
+    errorcode = _get_mysql().errorcode
+    return getattr(exc, 'errno', None) in (errorcode.CR_SERVER_GONE_ERROR, errorcode.ER_CLIENT_INTERACTION_TIMEOUT)
+
+
+def _retry_on_disconnect(func):
+    """
+    Decorator for functions which use `connect()` and can safely be run twice, such as
+    queries. If the database connection is found to have been lost, `connect()` discards
+    it and the function is called once more with a new connection
+
+    :param func: The function to wrap
+    :return: The wrapped function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except _get_mysql().Error as exc:
+            if not _connection_lost(exc):
+                raise
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _retry_if_unsent(func):
+    """
+    Decorator for functions which use `connect()` to insert rows, and so would insert them
+    twice if their statement is run again after it reached the server. The function is
+    only called once more if the connection was lost before that, such as when a pooled
+    connection had been closed by the server while it sat idle
+
+    :param func: The function to wrap
+    :return: The wrapped function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except _get_mysql().Error as exc:
+            if not _statement_unsent(exc):
+                raise
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _prepared_cursor(cnx: "mysql_connection", statement: str) -> "mysql_cursor":
+    """
+    Returns a cursor that runs `statement` as a server-side prepared statement. The
+    cursor is kept open for as long as its connection, so the server only has to parse
+    the statement the first time it is used on that connection.
+
+    The statement must use positional (%s) parameters and should be a module constant.
+    The connector only reuses a preparation if it is given the same string object
+
+    :param cnx: The connection borrowed from `connect()`
+    :param statement: The SQL statement that will be executed with the cursor
+    :return: The prepared cursor for the statement
+    """
+    cursors = _prepared_cursors.setdefault(cnx, {})
+    cursor = cursors.get(statement)
+    if cursor is None:
+        cursor = cursors[statement] = cnx.cursor(prepared=True)
+    return cursor
+
+
+def _execute_prepared(cnx: "mysql_connection", statement: str, data: tuple) -> list:
+    """
+    Executes a statement with its prepared cursor from `_prepared_cursor()`. Every row
+    of the result is read, so the cursor is ready to be executed again
+
+    :param cnx: The connection borrowed from `connect()`
+    :param statement: The SQL statement to execute. Must follow the rules of `_prepared_cursor()`
+    :param data: The values of the statement's parameters
+    :return: The rows returned by the statement. Empty if it doesn't return rows
     """
-    global _cnx
-    if _cnx is None:  # Connect to the database
-        _cnx = mysql.connector.connect(user=_CONFIG.values['MYSQL_USERNAME'],
-                                       password=_CONFIG.values['MYSQL_PASSWORD'],
-                                       host=_CONFIG.values['MYSQL_HOST'],
-                                       database=_CONFIG.values['MYSQL_DATABASE'],
-                                       autocommit=True)
-    if not _cnx.is_connected():  # Reconnect to the database if connection was lost
-        print("Reconnecting to database...")
-        _cnx.reconnect()
-    return _cnx.cursor()
+    cursor = _prepared_cursor(cnx, statement)
+    cursor.execute(statement, data)
+    return cursor.fetchall() if cursor.with_rows else []
 
 
 def close() -> None:
     """
-    Closes the connection to the database
+    Inserts any buffered images, then closes every idle connection to the database
     """
-    global _cnx
-    if _cnx:
-        _cnx.close()
-    _cnx = None
+    flush_images()  # Make sure no buffered images are lost. Also waits for a flush already underway
+    _close_idle_connections()
 
 
 # =======================================================================================================
@@ -57,22 +281,141 @@ def log_image(link_id: int, loop: int, left_camera: bool, passed: bool, file_pat
     :param time: The MySQL.Datetime equivalent string for when the image was first saved.
         If left out, the current time will be used
     """
-    global _last_id
-    statement = "INSERT INTO images (link_id, loop_count, left_camera, passed, filepath, time) VALUES (%(link_id)s, " \
-                "%(loop)s, %(left_camera)s, %(passed)s, %(filepath)s, %(time)s)"
-    data = {
+    global _last_image, _flush_timer
+    data = (link_id, loop, left_camera, passed, file_path, time)
+    # Only the insert is retried. Buffering the image again would insert it twice
+    if _batch_size > 1:  # Buffer the image to be inserted with the rest of its batch
+        with _image_buffer_lock:
+            _image_buffer.append(data)
+            full = len(_image_buffer) >= _batch_size
+            if not full and _flush_timer is None:  # Make sure the batch is inserted even if it never fills
+                _flush_timer = threading.Timer(_batch_interval_ms / 1000, flush_images)
+                _flush_timer.daemon = True
+                _flush_timer.start()
+        if full:
+            flush_images()
+        return
+    try:  # Parsed before the insert, so nothing can fail once the row has been written
+        logged_time = datetime.strptime(time, '%Y-%m-%d %H:%M:%S') if time else None
+    except (TypeError, ValueError):
+        logged_time = None
+    img_id = _insert_image(data)
+
+    if logged_time is None:  # The time the server stored isn't known, so the row has to be queried
+        _forget_last_image()
+        return
+    # Remember the row so `get_most_recent_image()` doesn't need to query for it
+    _last_image = {
+        'img_id': img_id,
         'link_id': link_id,
-        'loop': loop,
-        'left_camera': left_camera,
-        'passed': passed,
+        'loop_count': loop,
+        'left_camera': None if left_camera is None else int(left_camera),
+        'passed': None if passed is None else int(passed),
         'filepath': file_path,
-        'time': time
+        'time': logged_time
     }
-    cursor = connect()  # Verify database connection
-    cursor.execute(statement, data)
-    _last_id = cursor.lastrowid
 
 
+@_retry_if_unsent
+def _insert_image(data: tuple) -> int:
+    """
+    Inserts a single image for `log_image()`
+
+    :param data: The values of `log_image()`'s parameters, in the same order
+    :return: The id of the new row
+    """
+    with connect() as cnx:
+        cursor = _prepared_cursor(cnx, _LOG_IMAGE_STATEMENT)
+        cursor.execute(_LOG_IMAGE_STATEMENT, data)
+        return cursor.lastrowid
+
+
+def _forget_last_image() -> None:
+    """
+    Clears the remembered most recent image. Called whenever it may have been deleted
+    """
+    global _last_image
+    _last_image = None
+
+
+@_retry_if_unsent
+def log_and_trim(link_id: int, loop: int, left_camera: bool, passed: bool, file_path: str,
+                 keep_recent: int, keep_failures: int, time: str = None) -> None:
+    """
+    Adds an entry into the database for a given image, then removes the link's excess
+    images. This is the same as calling `log_image()` and then `trim_images()`, but both
+    are done by the `log_and_trim` stored procedure in one round-trip and transaction
+
+    :param link_id: The link number
+    :param loop: The number of loops the chain has made
+    :param left_camera: `True` if this image was captured with the left camera, `False` if captured with the right
+    :param passed: Whether link passed the inspection (i.e. a 'GOOD' image)
+    :param file_path: The path to the file where the image is being stored
+    :param keep_recent: The number of recent images to keep
+    :param keep_failures: The number of past failures to keep
+    :param time: The MySQL.Datetime equivalent string for when the image was first saved.
+        If left out, the current time will be used
+    """
+    statement = "CALL log_and_trim(%s, %s, %s, %s, %s, %s, %s, %s)"
+    data = (link_id, loop, left_camera, passed, file_path, time, keep_recent, keep_failures)
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement, data)
+    _forget_last_image()  # The procedure doesn't report the new image's id
+
+
+@_retry_if_unsent
+def log_images(images: list) -> None:
+    """
+    Adds entries into the database for several images using a single statement and transaction
+    :param images: A list of tuples, one for each image, containing the values of `log_image()`'s
+        parameters in the same order: (link_id, loop, left_camera, passed, file_path, time)
+    """
+    if not images:
+        return
+    with connect() as cnx, cnx.cursor() as cursor:
+        cnx.start_transaction()
+        cursor.executemany(_LOG_IMAGE_STATEMENT, images)
+        cnx.commit()
+    _forget_last_image()  # The id of the last row in a batch is not reported, so it has to be queried
+
+
+def set_image_batching(batch_size: int, interval_ms: int = 1000) -> None:
+    """
+    Sets how `log_image()` groups images together before inserting them. When the batch
+    size is greater than 1, images are buffered and inserted with `log_images()` once the
+    buffer fills or the interval has passed since the first image was buffered
+
+    :param batch_size: The number of images to insert at once. 1 disables batching
+    :param interval_ms: The maximum number of milliseconds an image will wait in the buffer
+    """
+    global _batch_size, _batch_interval_ms
+    flush_images()  # Insert anything buffered under the old settings
+    _batch_size = max(batch_size, 1)
+    _batch_interval_ms = max(interval_ms, 0)
+
+
+def flush_images() -> None:
+    """
+    Immediately inserts every image buffered by `log_image()`. If another thread is already
+    inserting the buffer, this waits for it to finish first. If the insert fails, the images
+    are put back in the buffer so they can be inserted later
+    """
+    global _image_buffer, _flush_timer
+    with _flush_lock:
+        with _image_buffer_lock:
+            if _flush_timer is not None:
+                _flush_timer.cancel()
+                _flush_timer = None
+            images, _image_buffer = _image_buffer, []
+        try:
+            log_images(images)
+        except Exception:
+            with _image_buffer_lock:  # Keep the images ahead of any buffered since
+                _image_buffer[:0] = images
+            raise
+
+
+@_retry_on_disconnect
 def clear_img_database(link_id: int = None) -> None:
     """
     Removes all images from the database for one link.
@@ -80,59 +423,58 @@ def clear_img_database(link_id: int = None) -> None:
 
     :param link_id: Specifies a single link to be removed
     """
-    if link_id:
-        imgs_statement = f"DELETE FROM images WHERE link_id={link_id}"
+    if link_id is not None:
+        imgs_statement = "DELETE FROM images WHERE link_id = %(link_id)s"
+        failures_statement = "DELETE FROM past_failures WHERE link_id = %(link_id)s"
     else:
         imgs_statement = "DELETE FROM images"
-    cursor = connect()
-    if link_id:
-        failures_statement = f"DELETE FROM past_failures WHERE link_id={link_id}"
-    else:
         failures_statement = "DELETE FROM past_failures"
-    try:
-        cursor.execute(imgs_statement)
-        cursor.execute(failures_statement)
-    except Exception as e:
-        close()
-        print(e)
+    data = {"link_id": link_id}
+    with connect() as cnx, cnx.cursor() as cursor:
+        _forget_last_image()
+        cursor.execute(imgs_statement, data)
+        cursor.execute(failures_statement, data)
 
 
+@_retry_on_disconnect
 def count_at_risk(threshold: float) -> int:
     """
     Counts the links that are "at risk" (i.e. have a dangerously low pass rate)
     :param threshold: The pass rate at or below which a link is considered "at risk"
     :return: The number of links below the threshold
     """
-    pass_rates = get_pass_rates()     # Get the pass rates for each link
-    count = 0
-    for rate in pass_rates.values():  # Count the links below the pass rate threshold
-        if rate <= threshold:
-            count += 1
-    return count
+    statement = "SELECT COUNT(*) FROM link_stats WHERE pass_rate <= %(threshold)s"
+    data = {"threshold": threshold}
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement, data)
+        return cursor.fetchone()[0]
 
 
+@_retry_on_disconnect
 def count_images() -> int:
     """
     Counts the images
     :return: The number of entries in the database
     """
     statement = "SELECT COUNT(*) FROM images"
-    cursor = connect()
-    cursor.execute(statement)
-    return cursor.fetchone()[0]
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement)
+        return cursor.fetchone()[0]
 
 
+@_retry_on_disconnect
 def count_links() -> int:
     """
     Counts the links
     :return: The number of links in the database
     """
     statement = "SELECT COUNT(DISTINCT(link_id)) FROM images"
-    cursor = connect()
-    cursor.execute(statement)
-    return cursor.fetchone()[0]
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement)
+        return cursor.fetchone()[0]
 
 
+@_retry_on_disconnect
 def count_no_match() -> float:
     """
     Returns the number of images which are null/NOMATCH
@@ -141,11 +483,12 @@ def count_no_match() -> float:
         If there are no images in the database, this value is None
     """
     statement = "SELECT COUNT(*) null_images FROM images WHERE passed IS NULL"
-    cursor = connect()
-    cursor.execute(statement)
-    return cursor.fetchone()[0]
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement)
+        return cursor.fetchone()[0]
 
 
+@_retry_on_disconnect
 def delete_image(img_id: int, past_failure=False) -> None:
     """
     Deletes an image from the database
@@ -158,10 +501,13 @@ def delete_image(img_id: int, past_failure=False) -> None:
     data = {
         "img_id": img_id
     }
-    cursor = connect()
-    cursor.execute(statement, data)
+    if not past_failure and _last_image is not None and _last_image['img_id'] == img_id:
+        _forget_last_image()
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement, data)
 
 
+@_retry_on_disconnect
 def fetch_link(link_id: int) -> dict:
     """
     Fetches the details on a given link from the database
@@ -169,59 +515,150 @@ def fetch_link(link_id: int) -> dict:
     :return: A dictionary containing the details of a given link. The dictionary contains the following items:
         "image_list" : list
             The list of recent images from both cameras
+        "pass_rate" : Optional[float]
+            The fraction of recent images that didn't fail. `None` if the link has no images
         "past_failures" : list
             A list of images that failed inspection that fell off the end of the camera lists
-    """
-    img_statement = "SELECT * FROM images WHERE link_id = %(link_id)s ORDER BY img_id DESC"
+        "last_time" : Optional[datetime]
+            When the most recent image was taken. `None` if the link has no images
+        "last_left_passed" : Optional[int]
+            The result of the left camera's most recent image. `None` if it had no match or there are none
+        "last_right_passed" : Optional[int]
+            The result of the right camera's most recent image. `None` if it had no match or there are none
+        Each image has the columns of its table, as well as "date_str" (YYYY-MM-DD), "time_str" (HH:MM:SS)
+        and "file" (the file name without its directory)
+    """
+    # Both tables are read in one query. The `source` column records which table each row came from.
+    # Each row also gets its date, time of day and file name as the strings shown on the webserver.
+    # These are cast to CHAR rather than formatted with DATE_FORMAT, whose '%' signs the connector's
+    # parameter substitution would misread
+    formatted = ("CAST(DATE(time) AS CHAR) date_str, CAST(TIME(time) AS CHAR) time_str, "
+                 "SUBSTRING_INDEX(filepath, '/', -1) file")
+    statement = (f"(SELECT 'i' source, images.*, {formatted} FROM images WHERE link_id = %(link_id)s) "
+                 "UNION ALL "
+                 f"(SELECT 'p' source, past_failures.*, {formatted} FROM past_failures WHERE link_id = %(link_id)s) "
+                 "ORDER BY source, img_id DESC")
     data = {"link_id": link_id}
-    cursor = connect()  # Verify database connection
-    cursor.execute(img_statement, data)
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement, data)
+        columns = cursor.column_names[1:]  # Skip the `source` column
+        rows = cursor.fetchall()
 
-    # Compile list of images with column names
-    image_list = [dict(zip(cursor.column_names, image)) for image in cursor]
+    image_rows = [row[1:] for row in rows if row[0] == 'i']
+    failure_rows = [row[1:] for row in rows if row[0] == 'p']
 
-    pf_statement = "SELECT * FROM past_failures WHERE link_id = %(link_id)s ORDER BY img_id DESC"
-    cursor = connect()  # Create a second cursor
-    cursor.execute(pf_statement, data)
+    # Calculate pass rate. Images with no match (NULL) are not counted as failures
+    passed_index = columns.index('passed')
+    pass_count = sum(1 for image in image_rows if image[passed_index] != 0)
+    pass_rate = pass_count / len(image_rows) if image_rows else None
 
-    # Calculate pass rate
-    pass_count = 0
-    for image in image_list:
-        if image['passed'] is not False:
-            pass_count += 1
-    pass_rate = pass_count / len(image_list)
+    # The images are ordered newest first, so the first image from each camera is its most recent
+    left_index = columns.index('left_camera')
+    last_left = next((image for image in image_rows if image[left_index]), None)
+    last_right = next((image for image in image_rows if not image[left_index]), None)
 
-    # Compile list of past failures with column names
-    failure_list = [dict(zip(cursor.column_names, image)) for image in cursor]
+    # Compile lists of images and past failures with column names
+    image_list = [dict(zip(columns, image)) for image in image_rows]
+    failure_list = [dict(zip(columns, image)) for image in failure_rows]
 
     return {
         "image_list": image_list,
         "pass_rate": pass_rate,
-        "past_failures": failure_list
+        "past_failures": failure_list,
+        "last_time": image_rows[0][columns.index('time')] if image_rows else None,
+        "last_left_passed": last_left[passed_index] if last_left is not None else None,
+        "last_right_passed": last_right[passed_index] if last_right is not None else None
     }
 
 
+@_retry_on_disconnect
 def find_worst_links(limit: int = 5) -> list:
     """
     Ranks the links by pass rate and returns a list of the N lowest
     :param limit: The number of links to find
-    :return: A list of tuples, containing the link ids and their pass rates.
-    """
-    statement = ("SELECT link_id, AVG(loop_passed) pass_rate FROM "
-                    "(SELECT link_id, loop_count, BIT_AND(passed) loop_passed "
-                    "FROM images "
-                    "GROUP BY link_id, loop_count) AS loops "
-                 "GROUP BY link_id "
-                 "ORDER BY pass_rate ASC "
-                 f"LIMIT {max(limit, 0)}")
-    cursor = connect()
-    cursor.execute(statement)
-    links = cursor.fetchall()
-    # Return empty list if database was empty
-    result = [(link[0], float(link[1])) for link in links] if links else []
-    return result
+    :return: A list of tuples, containing the link ids and their pass rates as percentages
+        rounded to 2 decimal places
+    """
+    statement = "SELECT link_id, ROUND(pass_rate * 100, 2) pct FROM link_stats ORDER BY pass_rate ASC LIMIT %(limit)s"
+    data = {"limit": max(limit, 0)}
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement, data)
+        # The pass rate is stored as a DOUBLE, so rows already hold floats. Empty list if database was empty
+        return cursor.fetchall()
+
+
+@_retry_on_disconnect
+def get_images_version() -> str:
+    """
+    Returns a string which changes whenever images are added to or removed from the images
+    table. Only indexes are read and nothing is grouped, so this is much cheaper than the
+    pass rate queries it is used to cache
+
+    :return: The id of the newest image and the number of images, joined by a hyphen
+    """
+    statement = "SELECT COALESCE(MAX(img_id), 0), COUNT(*) FROM images"
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement)
+        (max_id, count) = cursor.fetchone()
+    return f"{max_id}-{count}"
+
+
+@_retry_on_disconnect
+def get_index_overview(num_worst: int, warning_threshold: float, active_delay: int) -> dict:
+    """
+    Gathers the statistics shown on the webserver's homepage with the `index_overview`
+    stored procedure, which returns all of them in one round-trip
+
+    :param num_worst: The number of links with the lowest pass rates to find
+    :param warning_threshold: The pass rate at or below which a link is considered "at risk"
+    :param active_delay: The number of seconds since the most recent image within which the line is active
+    :return: A dictionary containing the following items:
+        "link_count" : int
+            The number of links, as in `count_links()`
+        "image_count" : int
+            The number of images, as in `count_images()`
+        "no_match" : int
+            The number of images with no match, as in `count_no_match()`
+        "most_recent" : Optional[dict]
+            The most recent image, as in `get_most_recent_image()`
+        "seconds_elapsed" : Optional[int]
+            The number of seconds since the most recent image was taken. `None` if there are no images
+        "active" : bool
+            Whether the most recent image was taken less than `active_delay` seconds ago
+        "worst" : list
+            The links with the lowest pass rates as percentages, as in `find_worst_links()`
+        "at_risk" : int
+            The number of links at risk, as in `count_at_risk()`
+    """
+    statement = "CALL index_overview(%s, %s, %s)"
+    data = (max(num_worst, 0), warning_threshold, active_delay)
+    with connect() as cnx, cnx.cursor() as cursor:
+        # Read the rows of each result set. The last result is the status of the CALL itself
+        results = [(result.column_names, result.fetchall())
+                   for result in cursor.execute(statement, data, multi=True) if result.with_rows]
+
+    (counts, recent, worst, at_risk) = results
+    (link_count, image_count, no_match) = counts[1][0]
+    (recent_columns, recent_rows) = recent
+    overview = {
+        "link_count": link_count,
+        "image_count": image_count,
+        "no_match": int(no_match),  # SUM() returns a Decimal
+        "most_recent": None,
+        "seconds_elapsed": None,
+        "active": False,
+        "worst": worst[1],
+        "at_risk": at_risk[1][0][0]
+    }
+    if recent_rows:  # Split the extra columns off the image's row
+        most_recent = dict(zip(recent_columns, recent_rows[0]))
+        overview["seconds_elapsed"] = most_recent.pop("seconds_elapsed")
+        overview["active"] = bool(most_recent.pop("active"))
+        overview["most_recent"] = most_recent
+    return overview
 
 
+@_retry_on_disconnect
 def get_most_recent_image() -> Optional[dict]:
     """
     Fetches the record for the most recently added image and returns the
@@ -229,17 +666,17 @@ def get_most_recent_image() -> Optional[dict]:
     :return: A dictionary containing the value of each column in the most recent
         image record. Returns "None" if there are no images in the database
     """
-    cursor = connect()
-    if _last_id:  # If cursor has last row ID, it removes the need for a query
-        statement = f"SELECT * FROM images WHERE img_id = {_last_id}"
-    else:
-        statement = "SELECT * FROM images WHERE img_id = (SELECT MAX(img_id) FROM images)"
-    cursor.execute(statement)
-    top_result = cursor.fetchone()
-    if top_result:  # Only return a dictionary if there is a result
-        return dict(zip(cursor.column_names, top_result))
+    if _last_image is not None:  # If this process logged the last image, it removes the need for a query
+        return dict(_last_image)
+    statement = "SELECT * FROM images ORDER BY img_id DESC LIMIT 1"
+    with connect() as cnx, cnx.cursor() as cursor:
+        cursor.execute(statement)
+        top_result = cursor.fetchone()
+        if top_result:  # Only return a dictionary if there is a result
+            return dict(zip(cursor.column_names, top_result))
 
 
+@_retry_on_disconnect
 def get_pass_rates() -> dict:
     """
     Returns the pass rates for every link in a dictionary, where the keys are the ids of each link
@@ -252,14 +689,40 @@ SELECT link_id, AVG(loop_passed) pass_rate FROM
      WHERE passed IS NOT NULL 
      GROUP BY link_id, loop_count) AS loops 
 GROUP BY link_id""")
-    cursor = connect()
-    cursor.execute(statement)
-    results = {}
-    for (link_id, pass_rate) in cursor:
-        results[link_id] = float(pass_rate)
-    return results
+    with connect() as cnx, cnx.cursor(buffered=True) as cursor:
+        cursor.execute(statement)
+        return {link_id: float(pass_rate) for (link_id, pass_rate) in cursor.fetchall()}
 
 
+@_retry_on_disconnect
+def get_pass_rates_sorted() -> list:
+    """
+    Returns the pass rate of every link along with the color of its cell on the webserver's
+    grid page, ordered by link id. The color is the pass rate squared (to inflate lower scores)
+    blended from red (0) to blue (1)
+
+    :return: A list of tuples, one for each link, containing the link's id, its pass rate as a
+        percentage rounded to 3 decimal places, and its color as a hex color code (e.g. "#FF0000")
+    """
+    statement = ("""
+SELECT link_id,
+       ROUND(pass_rate * 100, 3) pass_rate,
+       CONCAT('#', LPAD(HEX((FLOOR(255 * (1 - pass_rate * pass_rate)) << 16)
+                            + FLOOR(255 * pass_rate * pass_rate)), 6, '0')) color
+FROM
+    (SELECT link_id, CAST(AVG(loop_passed) AS DOUBLE) pass_rate FROM
+        (SELECT link_id, loop_count, BIT_AND(passed) loop_passed
+         FROM images
+         WHERE passed IS NOT NULL
+         GROUP BY link_id, loop_count) AS loops
+     GROUP BY link_id) AS rates
+ORDER BY link_id""")
+    with connect() as cnx, cnx.cursor(buffered=True) as cursor:
+        cursor.execute(statement)
+        return cursor.fetchall()
+
+
+@_retry_on_disconnect
 def trim_images(link: int, keep_recent: int, keep_failures: int) -> None:
     """
     Removes excess images from the database.
@@ -268,54 +731,24 @@ def trim_images(link: int, keep_recent: int, keep_failures: int) -> None:
     :param keep_recent: The number of recent images to keep
     :param keep_failures: The number of past failures to keep
     """
-    # These queries are as horrifying to read as they were for me to write. I'm sorry.
-    transfer_statement = ("INSERT INTO past_failures "
-                          "SELECT * FROM images "
-                          "WHERE NOT passed AND "
-                          "img_id IN (SELECT * FROM ("
-                          "SELECT img_id FROM images "
-                          "WHERE link_id = %(link_id)s "
-                          "ORDER BY img_id DESC "
-                          "LIMIT 1000 OFFSET %(offset)s) temp )")
-
-    remove_images = ("DELETE FROM images WHERE link_id = %(link_id)s AND img_id <= "
-                     "(SELECT img_id FROM images "
-                     "WHERE link_id = %(link_id)s "
-                     "ORDER BY img_id DESC "
-                     "LIMIT 1 OFFSET %(offset)s)")
-    remove_failures = ("DELETE FROM past_failures WHERE link_id = %(link_id)s AND img_id <= "
-                       "(SELECT img_id FROM past_failures "
-                       "WHERE link_id = %(link_id)s "
-                       "ORDER BY img_id DESC "
-                       "LIMIT 1 OFFSET %(offset)s)")
-    cursor = connect()
-
-    """ Transfer overflow failures from images to past_failures """
-    transfer_data = {
-        "link_id": link,
-        "offset": keep_recent
-    }
+    with connect() as cnx:
+        cnx.start_transaction()  # Begin a transaction
 
-    """ Remove old images from both tables """
-    recent_data = {
-        "link_id": link,
-        "offset": keep_recent
-    }
+        """ Transfer overflow failures from images to past_failures, then remove them from images """
+        cutoff_rows = _execute_prepared(cnx, _RECENT_CUTOFF_STATEMENT, (link, keep_recent))
+        if cutoff_rows:  # Only trim if there are more images than the limit
+            data = (link, cutoff_rows[0][0])
+            if _last_image is not None and _last_image['link_id'] == link and _last_image['img_id'] <= data[1]:
+                _forget_last_image()
+            _execute_prepared(cnx, _TRANSFER_STATEMENT, data)       # Move old failed inspections to past_failures
+            _execute_prepared(cnx, _REMOVE_IMAGES_STATEMENT, data)  # Trim old inspections from images
 
-    failure_data = {
-        "link_id": link,
-        "offset": keep_failures
-    }
+        """ Remove old images from past_failures """
+        cutoff_rows = _execute_prepared(cnx, _FAILURE_CUTOFF_STATEMENT, (link, keep_failures))
+        if cutoff_rows:
+            _execute_prepared(cnx, _REMOVE_FAILURES_STATEMENT, (link, cutoff_rows[0][0]))
 
-    try:
-        _cnx.start_transaction()                           # Begin a transaction
-        cursor.execute(transfer_statement, transfer_data)  # Transfer old failed inspections to past_failures
-        cursor.execute(remove_images, recent_data)         # Trim old inspections from images
-        cursor.execute(remove_failures, failure_data)      # Trim old inspections from past_failures
-        _cnx.commit()                                      # Commit transaction
-    except Exception as e:  # If the transaction fails, abort and close the connection to prevent a crash
-        close()
-        print(e)
+        cnx.commit()  # Commit transaction
 
 
 # =======================================================================================================
@@ -324,26 +757,25 @@ def trim_images(link: int, keep_recent: int, keep_failures: int) -> None:
 
 # Note: This has been added for building additional features. It does not have any use at present.
 
+@functools.lru_cache(maxsize=256)
+@_retry_on_disconnect
 def get_attribute(attribute: str) -> Optional[str]:
     """
-    Fetches an attribute from the configuration table
+    Fetches an attribute from the configuration table. Results are cached until the
+    table is written to by `set_attribute()` or `reload_config_cache()` is called
 
     :param attribute: The key/name for the value
     :raises ValueError: If the attribute does not exist in the table
     :return: The value of the attribute
     """
-    update_statement = "SELECT value FROM config WHERE attribute = %(attribute)s"
-    data = {
-        'attribute': attribute,
-    }
-    cursor = connect()
-    cursor.execute(update_statement, data)
-    result = cursor.fetchone()
-    if result is None:
+    with connect() as cnx:
+        rows = _execute_prepared(cnx, _GET_ATTRIBUTE_STATEMENT, (attribute,))
+    if not rows:
         raise ValueError(f"No attribute {attribute} in configuration table")
-    return result[0]
+    return rows[0][0]
 
 
+@_retry_on_disconnect
 def set_attribute(attribute: str, value, no_insert: bool = False) -> None:
     """
     Updates the value of an attribute in the configuration database.
@@ -358,17 +790,22 @@ def set_attribute(attribute: str, value, no_insert: bool = False) -> None:
         existing entry in the table. Otherwise, the new attribute will be inserted
     :raises ValueError: If no_insert is `True` and the attribute does not exist in the table
     """
-    update_statement = "UPDATE config SET value = %(value)s WHERE attribute = %(attribute)s"
-    data = {
-        'attribute': attribute,
-        'value': str(value) if value is not None else None  # Cast non-None values to string
-    }
-    cursor = connect()
-    _cnx.start_transaction()
-    cursor.execute(update_statement, data)
-    if cursor.rowcount == 0:  # If attribute was not in table, insert if allowed
+    value = str(value) if value is not None else None  # Cast non-None values to string
+    with connect() as cnx:
         if no_insert:
-            raise ValueError(f"No attribute {attribute} in configuration table")
-        insert_statement = f"INSERT INTO config VALUES (%(attribute)s, %(value)s)"
-        cursor.execute(insert_statement, data)
-    _cnx.commit()
+            cursor = _prepared_cursor(cnx, _UPDATE_ATTRIBUTE_STATEMENT)
+            cursor.execute(_UPDATE_ATTRIBUTE_STATEMENT, (value, attribute))
+            if cursor.rowcount == 0:  # Rows whose value didn't change aren't counted, so check it exists
+                if not _execute_prepared(cnx, _GET_ATTRIBUTE_STATEMENT, (attribute,)):
+                    raise ValueError(f"No attribute {attribute} in configuration table")
+        else:  # Insert the attribute, or update it if it is already in the table
+            _execute_prepared(cnx, _UPSERT_ATTRIBUTE_STATEMENT, (attribute, value))
+    get_attribute.cache_clear()
+
+
+def reload_config_cache() -> None:
+    """
+    Discards the cached results of `get_attribute()`, so the next call for each
+    attribute reads it from the table again
+    """
+    get_attribute.cache_clear()
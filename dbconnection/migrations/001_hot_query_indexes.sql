@@ -0,0 +1,13 @@
+-- Indexes for the queries run on every file event and page load
+--
+-- fetch_link, trim_images, and clear_img_database all filter on link_id and
+-- order by img_id, so the composite indexes let them read a link's rows as a
+-- single index range instead of scanning the table. count_no_match filters on
+-- passed.
+--
+-- Run once against the ChainWatch database:
+--     mysql -u ChainWatch -p ChainWatch < dbconnection/migrations/001_hot_query_indexes.sql
+
+CREATE INDEX ix_images_link_img ON images (link_id, img_id DESC);
+CREATE INDEX ix_past_failures_link_img ON past_failures (link_id, img_id DESC);
+CREATE INDEX ix_images_passed ON images (passed);
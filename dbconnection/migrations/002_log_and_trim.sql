@@ -0,0 +1,58 @@
+-- Stored procedure used by dbconnection.log_and_trim()
+--
+-- Logs an image and trims the link's images in one server-side transaction,
+-- so that each file event costs a single round-trip. The trim follows the same
+-- steps as dbconnection.trim_images().
+--
+-- Run once against the ChainWatch database:
+--     mysql -u ChainWatch -p ChainWatch < dbconnection/migrations/002_log_and_trim.sql
+
+DROP PROCEDURE IF EXISTS log_and_trim;
+
+DELIMITER //
+CREATE PROCEDURE log_and_trim(IN p_link_id INT,
+                              IN p_loop INT,
+                              IN p_left_camera BOOLEAN,
+                              IN p_passed BOOLEAN,
+                              IN p_filepath VARCHAR(255),
+                              IN p_time DATETIME,
+                              IN p_keep_recent INT,
+                              IN p_keep_failures INT)
+BEGIN
+    DECLARE recent_cutoff INT DEFAULT NULL;
+    DECLARE failure_cutoff INT DEFAULT NULL;
+    DECLARE EXIT HANDLER FOR SQLEXCEPTION
+    BEGIN
+        ROLLBACK;
+        RESIGNAL;
+    END;
+
+    START TRANSACTION;
+
+    INSERT INTO images (link_id, loop_count, left_camera, passed, filepath, time)
+    VALUES (p_link_id, p_loop, p_left_camera, p_passed, p_filepath, p_time);
+
+    -- Transfer overflow failures from images to past_failures, then remove them from images
+    SELECT img_id INTO recent_cutoff FROM images
+    WHERE link_id = p_link_id
+    ORDER BY img_id DESC
+    LIMIT 1 OFFSET p_keep_recent;
+    IF recent_cutoff IS NOT NULL THEN
+        INSERT INTO past_failures
+        SELECT * FROM images
+        WHERE link_id = p_link_id AND NOT passed AND img_id <= recent_cutoff;
+        DELETE FROM images WHERE link_id = p_link_id AND img_id <= recent_cutoff;
+    END IF;
+
+    -- Remove old images from past_failures
+    SELECT img_id INTO failure_cutoff FROM past_failures
+    WHERE link_id = p_link_id
+    ORDER BY img_id DESC
+    LIMIT 1 OFFSET p_keep_failures;
+    IF failure_cutoff IS NOT NULL THEN
+        DELETE FROM past_failures WHERE link_id = p_link_id AND img_id <= failure_cutoff;
+    END IF;
+
+    COMMIT;
+END //
+DELIMITER ;
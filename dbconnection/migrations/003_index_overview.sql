@@ -0,0 +1,53 @@
+-- Stored procedure used by dbconnection.get_index_overview()
+--
+-- Gathers everything the webserver's homepage shows in one round-trip. It
+-- returns four result sets:
+--     1. The number of links, images and images with no match
+--     2. The most recent image, the number of seconds since it was taken and
+--        whether that is less than p_active_delay (i.e. the line is active)
+--     3. The p_num_worst links with the lowest pass rates, as percentages
+--     4. The number of links whose pass rate is at or below p_threshold
+--
+-- Run once against the ChainWatch database:
+--     mysql -u ChainWatch -p ChainWatch < dbconnection/migrations/003_index_overview.sql
+
+DROP PROCEDURE IF EXISTS index_overview;
+
+DELIMITER //
+CREATE PROCEDURE index_overview(IN p_num_worst INT,
+                                IN p_threshold DOUBLE,
+                                IN p_active_delay INT)
+BEGIN
+    SELECT COUNT(DISTINCT link_id) link_count,
+           COUNT(*) image_count,
+           COALESCE(SUM(passed IS NULL), 0) no_match
+    FROM images;
+
+    SELECT images.*,
+           TIMESTAMPDIFF(SECOND, time, NOW()) seconds_elapsed,
+           TIMESTAMPDIFF(SECOND, time, NOW()) < p_active_delay active
+    FROM images
+    ORDER BY img_id DESC
+    LIMIT 1;
+
+    WITH loops AS
+        (SELECT link_id, loop_count, BIT_AND(passed) loop_passed
+         FROM images
+         WHERE passed IS NOT NULL
+         GROUP BY link_id, loop_count)
+    SELECT link_id, CAST(ROUND(AVG(loop_passed) * 100, 2) AS DOUBLE) pct FROM loops
+    GROUP BY link_id
+    ORDER BY AVG(loop_passed) ASC
+    LIMIT p_num_worst;
+
+    WITH loops AS
+        (SELECT link_id, loop_count, BIT_AND(passed) loop_passed
+         FROM images
+         WHERE passed IS NOT NULL
+         GROUP BY link_id, loop_count)
+    SELECT COUNT(*) FROM
+        (SELECT link_id FROM loops
+         GROUP BY link_id
+         HAVING AVG(loop_passed) <= p_threshold) AS at_risk;
+END //
+DELIMITER ;
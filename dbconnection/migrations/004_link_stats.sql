@@ -0,0 +1,95 @@
+-- Summary table of each link's pass rate
+--
+-- The homepage's worst links and at-risk count used to compute every link's
+-- pass rate from the images table on each page load. link_stats stores the
+-- pass rates instead, so both become a lookup on its pass_rate index.
+--
+-- A link's row is recomputed by the refresh_link_stats procedure, which
+-- triggers on the images table call for every row inserted, updated or
+-- deleted. The summary is therefore changed by the same statement (and in the
+-- same transaction) as the images, so readers never see it out of step and no
+-- caller has to remember to refresh it. index_overview is redefined here to
+-- read from the table.
+--
+-- Run once against the ChainWatch database, after 003:
+--     mysql -u ChainWatch -p ChainWatch < dbconnection/migrations/004_link_stats.sql
+
+CREATE TABLE IF NOT EXISTS link_stats (
+    link_id INT NOT NULL PRIMARY KEY,
+    pass_rate DOUBLE NOT NULL,
+    INDEX ix_link_stats_pass_rate (pass_rate)
+);
+
+-- Fill the table from the images already logged
+REPLACE INTO link_stats (link_id, pass_rate)
+SELECT link_id, AVG(loop_passed) FROM
+    (SELECT link_id, loop_count, BIT_AND(passed) loop_passed
+     FROM images
+     WHERE passed IS NOT NULL
+     GROUP BY link_id, loop_count) AS loops
+GROUP BY link_id;
+
+DROP TRIGGER IF EXISTS images_after_insert;
+DROP TRIGGER IF EXISTS images_after_update;
+DROP TRIGGER IF EXISTS images_after_delete;
+DROP PROCEDURE IF EXISTS refresh_link_stats;
+DROP PROCEDURE IF EXISTS index_overview;
+
+DELIMITER //
+-- Recomputes the pass rate of one link. The row is updated in place rather than
+-- replaced, and links without any matched images have no row
+CREATE PROCEDURE refresh_link_stats(IN p_link_id INT)
+BEGIN
+    INSERT INTO link_stats (link_id, pass_rate)
+    SELECT link_id, AVG(loop_passed) FROM
+        (SELECT link_id, loop_count, BIT_AND(passed) loop_passed
+         FROM images
+         WHERE link_id = p_link_id AND passed IS NOT NULL
+         GROUP BY link_id, loop_count) AS loops
+    GROUP BY link_id
+    ON DUPLICATE KEY UPDATE pass_rate = VALUES(pass_rate);
+    IF NOT EXISTS (SELECT 1 FROM images WHERE link_id = p_link_id AND passed IS NOT NULL) THEN
+        DELETE FROM link_stats WHERE link_id = p_link_id;
+    END IF;
+END //
+
+CREATE TRIGGER images_after_insert AFTER INSERT ON images
+FOR EACH ROW CALL refresh_link_stats(NEW.link_id) //
+
+CREATE TRIGGER images_after_delete AFTER DELETE ON images
+FOR EACH ROW CALL refresh_link_stats(OLD.link_id) //
+
+-- An update may move an image to another link, in which case both links change
+CREATE TRIGGER images_after_update AFTER UPDATE ON images
+FOR EACH ROW
+BEGIN
+    CALL refresh_link_stats(NEW.link_id);
+    IF NOT (OLD.link_id <=> NEW.link_id) THEN
+        CALL refresh_link_stats(OLD.link_id);
+    END IF;
+END //
+
+-- The same as in 003, with the worst links and at-risk count read from link_stats
+CREATE PROCEDURE index_overview(IN p_num_worst INT,
+                                IN p_threshold DOUBLE,
+                                IN p_active_delay INT)
+BEGIN
+    SELECT COUNT(DISTINCT link_id) link_count,
+           COUNT(*) image_count,
+           COALESCE(SUM(passed IS NULL), 0) no_match
+    FROM images;
+
+    SELECT images.*,
+           TIMESTAMPDIFF(SECOND, time, NOW()) seconds_elapsed,
+           TIMESTAMPDIFF(SECOND, time, NOW()) < p_active_delay active
+    FROM images
+    ORDER BY img_id DESC
+    LIMIT 1;
+
+    SELECT link_id, ROUND(pass_rate * 100, 2) pct FROM link_stats
+    ORDER BY pass_rate ASC
+    LIMIT p_num_worst;
+
+    SELECT COUNT(*) FROM link_stats WHERE pass_rate <= p_threshold;
+END //
+DELIMITER ;
@@ -3,8 +3,11 @@
 # First party imports
 import argparse
 from datetime import datetime
+import errno
 import os
+import re
 import shutil
+import time
 # Personal imports
 from filewatcher import FileWatcher, FileEvent
 import dbconnection
@@ -16,6 +19,20 @@ CONFIG = None                            # The configuration object
 CONFIG_FILE = "config.json"              # The name of the module's configuration file
 MODULE_DIR = os.path.split(__file__)[0]  # The directory of this module
 
+_IGNORED_DIRS = frozenset({MODULE_DIR})  # The watched directories which `detect_file` doesn't look for images in
+
+_NAME_RE = re.compile(r"(\w+)_(\w+)_LP-(\d+)_ID-(\d+)(?:_(\d{10}))?")  # The pattern of image file names
+
+# Values from CONFIG used for every file event. Set by `_cache_config()` whenever the config is loaded
+_PASS_TAG = None
+_FAIL_TAG = None
+_UNKNOWN_TAG = None
+_LEFT_CAMERA = None
+_RIGHT_CAMERA = None
+_IMG_DEST = None
+_RECENT_IMAGE_LIMIT = None
+_FAIL_IMAGE_LIMIT = None
+
 
 def parse_name(file_name: str):
     """
@@ -37,21 +54,21 @@ def parse_name(file_name: str):
         3 : str
             The name of the camera this photo came from
     """
-    import re
-    parsed = re.search(r"(\w+)_(\w+)_LP-(\d+)_ID-(\d+)(?:_(\d{10}))?", file_name)
+    parsed = _NAME_RE.search(file_name)
     if parsed is None:  # Reject invalid
         print(f"Couldn't parse file name `{file_name}`")
         return None
 
     camera = parsed.group(1)  # Get the camera name
-    if parsed.group(2) == CONFIG['PASS_TAG']:
+    result = parsed.group(2)
+    if result == _PASS_TAG:
         passed = True
-    elif parsed.group(2) == CONFIG['FAIL_TAG']:
+    elif result == _FAIL_TAG:
         passed = False
-    elif parsed.group(2) == CONFIG['UNKNOWN_TAG']:
+    elif result == _UNKNOWN_TAG:
         passed = None
     else:
-        print(f"Unrecognized inspection result `{parsed.group(2)}`")
+        print(f"Unrecognized inspection result `{result}`")
         return None
     loop_id = int(parsed.group(3))
     link_id = int(parsed.group(4))
@@ -59,6 +76,16 @@ def parse_name(file_name: str):
     return passed, loop_id, link_id, camera, timestamp
 
 
+def ignore_dir(path: str) -> None:
+    """
+    Stops `detect_file` from processing files inside a directory
+
+    :param path: The directory to ignore
+    """
+    global _IGNORED_DIRS
+    _IGNORED_DIRS = _IGNORED_DIRS | {path}
+
+
 def detect_file(data: (FileEvent, str, str)) -> None:
     """
     The target function which gets called when a file is detected
@@ -68,7 +95,7 @@ def detect_file(data: (FileEvent, str, str)) -> None:
         - the name of the folder the file was inside
     """
     (event, name, dir_path) = data
-    if dir_path == MODULE_DIR:  # Ignore the module directory
+    if dir_path in _IGNORED_DIRS:  # Ignore the module directory and any others marked by `ignore_dir()`
         return
 
     """ Parse filename """
@@ -76,7 +103,7 @@ def detect_file(data: (FileEvent, str, str)) -> None:
     file_data = parse_name(name)
     if file_data is None:
         return
-    (passed, loop_count, link_id, camera, timestamp) = parse_name(name)
+    (passed, loop_count, link_id, camera, timestamp) = file_data
     print(f"Found `{name}` from camera `{camera}`")
 
     # Convert timestamp integer to MySQL formatted datetime string
@@ -84,30 +111,35 @@ def detect_file(data: (FileEvent, str, str)) -> None:
 
     """ Process camera name """
 
-    if camera == CONFIG['LEFT_CAMERA']:
+    if camera == _LEFT_CAMERA:
         left_camera = True
-    elif camera == CONFIG['RIGHT_CAMERA']:
+    elif camera == _RIGHT_CAMERA:
         left_camera = False
     else:
         left_camera = None
 
     """ Move file """
 
-    source = f"{dir_path}/{name}"
+    source = os.path.join(dir_path, name)
     if timestamp is not None:  # Don't rename file if POSIX timestamp already in filename
-        dest = f"{CONFIG['IMG_DESTINATION']}/{name}"
+        dest = os.path.join(_IMG_DEST, name)
     else:
         filename, file_ext = os.path.splitext(name)
-        time = datetime.utcnow()                                    # Get the current time
-        new_name = f"{filename}_{int(time.timestamp())}{file_ext}"  # Encode POSIX timestamp in filename
-        dest = f"{CONFIG['IMG_DESTINATION']}/{new_name}"
+        new_name = f"{filename}_{int(time.time())}{file_ext}"  # Encode POSIX timestamp in filename
+        dest = os.path.join(_IMG_DEST, new_name)
 
-    shutil.move(source, dest)  # Move the file into the destination folder
+    try:  # Move the file into the destination folder
+        os.replace(source, dest)  # A single rename when both folders are on the same filesystem
+    except OSError as exc:
+        if exc.errno != errno.EXDEV:
+            raise
+        shutil.move(source, dest)  # Copy the file across filesystems
 
     """ Update Database """
 
-    dbconnection.log_image(link_id, loop_count, left_camera, passed, dest, time=timestr)  # Add image to database
-    dbconnection.trim_images(link_id, CONFIG['RECENT_IMAGE_LIMIT'], CONFIG['FAIL_IMAGE_LIMIT'])
+    # Add image to database and remove the link's excess images
+    dbconnection.log_and_trim(link_id, loop_count, left_camera, passed, dest,
+                              _RECENT_IMAGE_LIMIT, _FAIL_IMAGE_LIMIT, time=timestr)
 
 
 def load_config() -> None:
@@ -120,9 +152,27 @@ def load_config() -> None:
         "IMG_DESTINATION": str
     }
     CONFIG = Config(f"{MODULE_DIR}/{CONFIG_FILE}", required_keys=required_keys)
+    _cache_config()
     print("Loaded config file.")
 
 
+def _cache_config() -> None:
+    """
+    Copies the config values used by every file event into module variables,
+    so they don't need to be looked up in CONFIG each time
+    """
+    global _PASS_TAG, _FAIL_TAG, _UNKNOWN_TAG, _LEFT_CAMERA, _RIGHT_CAMERA
+    global _IMG_DEST, _RECENT_IMAGE_LIMIT, _FAIL_IMAGE_LIMIT
+    _PASS_TAG = CONFIG['PASS_TAG']
+    _FAIL_TAG = CONFIG['FAIL_TAG']
+    _UNKNOWN_TAG = CONFIG['UNKNOWN_TAG']
+    _LEFT_CAMERA = CONFIG['LEFT_CAMERA']
+    _RIGHT_CAMERA = CONFIG['RIGHT_CAMERA']
+    _IMG_DEST = CONFIG['IMG_DESTINATION']
+    _RECENT_IMAGE_LIMIT = CONFIG['RECENT_IMAGE_LIMIT']
+    _FAIL_IMAGE_LIMIT = CONFIG['FAIL_IMAGE_LIMIT']
+
+
 def reload(data: (FileEvent, str, str)) -> None:
     """
     FileWatcher target for reloading script files
@@ -131,9 +181,11 @@ def reload(data: (FileEvent, str, str)) -> None:
     """
     (event, name, dir_path) = data
     # Ignore anything but the config file in the package directory
-    if not dir_path == MODULE_DIR or not name == CONFIG_FILE:
+    if name != CONFIG_FILE or dir_path != MODULE_DIR:
         return
     CONFIG.reload()
+    _cache_config()
+    dbconnection.reload_config_cache()
     print("Config file reloaded.")
 
 
@@ -149,10 +201,6 @@ if __name__ == "__main__":
                         "--recursive",
                         action="store_true",
                         help="Events will also be triggered for all subdirectories of the one being watched")
-    parser.add_argument("-S",
-                        "--synchronous",
-                        action="store_true",
-                        help="Whether to disable threading of targets, causing them to execute synchronously.")
     parser.add_argument("paths", nargs='+', help="The paths of each directory to watch")
     args = parser.parse_args()
 
@@ -162,21 +210,20 @@ if __name__ == "__main__":
 
     # ------ Start file watchdog
 
-    # Check that every path requested exists
-    for path in args.paths:
-        if not os.path.exists(path):
-            raise FileNotFoundError(f"Could not locate the directory {path}")
-
     # Also watch the config directory for changes to the config file
-    paths = args.paths
-    paths.append(MODULE_DIR)
+    paths = list(args.paths) + [MODULE_DIR]
+
+    # Check that every path requested exists
+    missing = [path for path in paths if not os.path.isdir(path)]
+    if missing:
+        raise FileNotFoundError(f"Could not locate the directories {missing}")
 
     # Start and run the watchdog
-    watchdog = FileWatcher(args.paths,
-                           recursive=args.recursive,
-                           threaded_events=args.recursive)               # Create the FileWatcher object
-    watchdog.register_target(reload, events=FileEvent.CLOSE_WRITE)       # Reload config file when modified
-    watchdog.register_target(detect_file, events=FileEvent.CLOSE_WRITE)  # Watch FTP directory
+    watchdog = FileWatcher(paths, recursive=args.recursive)              # Create the FileWatcher object
+    # Both targets run on the listener's thread, so the config is never reloaded while detect_file reads it
+    watchdog.register_target(reload, events=FileEvent.CLOSE_WRITE, async_exec=False)  # Reload config file
+    # Images are logged one at a time anyway, so worker threads would only wait on each other
+    watchdog.register_target(detect_file, events=FileEvent.CLOSE_WRITE, async_exec=False)  # Watch FTP directory
     print("Starting filewatcher...")
     watchdog.start()                                                     # Begin watching the directory
     dbconnection.close()                                                 # Close database
@@ -47,3 +47,7 @@ class FileEvent(Enum):
     READ = "IN_ACCESS"
     REMOVE = "IN_MOVED_FROM"
     UNWATCH = "IN_IGNORED"
+
+
+# Look up FileEvents by their inotify names without going through `Enum.__call__`
+FileEvent._by_value = {member.value: member for member in FileEvent}
@@ -6,12 +6,22 @@ SICK_FTP_Test
 """
 
 # Standard library modules
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import selectors
 import threading
+import time
+import traceback
 from typing import Callable, Union
 
-import inotify.adapters as adapters
+from inotify_simple import INotify, flags, masks
 from filewatcher.fileEvent import FileEvent
 
+# The number of asynchronous target calls each worker thread may have waiting before the listener blocks
+_QUEUED_PER_WORKER = 4
+# The inotify mask bit for each FileEvent type
+_EVENT_MASKS = {event: int(flags[name[len("IN_"):]]) for (name, event) in FileEvent._by_value.items()}
+
 
 class FileWatcher:
     """
@@ -41,20 +51,31 @@ class FileWatcher:
     :param recursive: Whether to watch the subdirectories as well. Defaults
                 to `False` If set to 'True', then it will trigger when a
                 file event occurs within a subdirectory
-    :param threaded_events: Whether SICK_FTP_Test should join the threads
-                for each target call or run them concurrently. Defaults to
-                `True`. If set to `False` it will ensure that all targets
-                finish execution before the next event is handled, however
-                it will also block execution of the other events if one or
-                more tasks takes a while to execute
+    :param threaded_events: Whether SICK_FTP_Test should call each target
+                in turn or run them concurrently on a pool of worker threads.
+                Defaults to `False`, which ensures that all targets finish
+                execution before the next event is handled, however it will
+                also block execution of the other events if one or more tasks
+                takes a while to execute. This is only the default for each
+                target, and can be overridden with `register_target()`'s
+                `async_exec` parameter
+    :param coalesce_ms: How long in milliseconds to hold each event before
+                calling its targets. Identical events (the same FileEvent,
+                file name and directory) seen within that time only call the
+                targets once. Defaults to `50`. If set to `0`, targets are
+                called as soon as each event is read
     """
 
-    def __init__(self, path, recursive=False, threaded_events=True):
+    def __init__(self, path, recursive=False, threaded_events=False, coalesce_ms=50):
         self._listening = False
         self._event_targets = {}
+        self._dispatch = ()  # (mask bit, FileEvent, targets) for each FileEvent with targets. See `_build_dispatch()`
         self._threaded = threaded_events
-        self._event_threads = []
+        self._pool = None  # The worker threads for asynchronous targets while listening
+        self._pool_slots = None  # Limits how many calls can be submitted to the pool but not yet finished
         self._recursive = recursive
+        self._coalesce_s = coalesce_ms / 1000
+        self._pending = {}  # The deadline and targets of each held (FileEvent, file name, directory) event
 
         self._paths = [path] if isinstance(path, str) else path  # Convert single string to list
 
@@ -62,13 +83,30 @@ class FileWatcher:
         for event in FileEvent:
             self._event_targets[event] = {}
 
-        # Create an adapter of the right behavior
-        if recursive:
-            self.adapter = adapters.InotifyTrees(self._paths, block_duration_s=0.1)
-        else:
-            self.adapter = adapters.Inotify(block_duration_s=0.1)
-            for dir_path in self._paths:
-                self.adapter.add_watch(dir_path)
+        # Create the adapter and watch every directory
+        self.adapter = INotify()
+        self._watch_paths = {}       # The directory watched by each inotify watch descriptor
+        self._watched_paths = set()  # Every directory being watched, including subdirectories
+        for dir_path in self._paths:
+            self._add_watch(dir_path)
+
+        # `stop()` writes to this pipe to wake up `listen()` while it waits for events
+        self._wakeup_read, self._wakeup_write = os.pipe()
+
+    def _add_watch(self, path: str) -> None:
+        """
+        Starts watching a directory. If this filewatcher is recursive, all of
+        its subdirectories are watched as well
+
+        :param path: The directory to watch
+        """
+        dir_paths = [root for (root, _, _) in os.walk(path)] if self._recursive else [path]
+        for dir_path in dir_paths:
+            if dir_path in self._watched_paths:  # Don't add directories which are already watched
+                continue
+            wd = self.adapter.add_watch(dir_path, masks.ALL_EVENTS)
+            self._watch_paths[wd] = dir_path
+            self._watched_paths.add(dir_path)
 
     def add_path(self, path) -> None:
         """
@@ -80,15 +118,12 @@ class FileWatcher:
         paths = [path] if isinstance(path, str) else path                  # Convert single string to list
         paths = [unique for unique in paths if unique not in self._paths]  # Filter out duplicates
 
-        if self._recursive:
-            """ Unlike Inotify, InotifyTrees does not expose a method for adding directories 
-            after init, so I have to make a call to one of its unexposed helper methods """
-            self.adapter.__load_trees(paths)
-        else:
-            for new_path in paths:
-                self.adapter.add_watch(new_path)
+        self._paths = self._paths + paths
+        for new_path in paths:  # Only the new directories are walked, even when recursive
+            self._add_watch(new_path)
 
-    def register_target(self, target: Callable, events: Union[FileEvent, list] = None, tag=None) -> bool:
+    def register_target(self, target: Callable, events: Union[FileEvent, list] = None, tag=None,
+                        async_exec: bool = None) -> bool:
         """
         Registers a function to be called when a file event occurs. The function must
         accept one parameter, a tuple with the following values:
@@ -115,11 +150,16 @@ class FileWatcher:
             Specifies a single or group of FileEvents that the target will be
             called in response to. If no value is provided, the target will be
             registered for all events. If a list of FileEvents is given, the
-            target will be registered for all types listed.
+            target will be registered for all types listed. FileEvents may also
+            be given by their inotify names (e.g. "IN_CLOSE_WRITE")
         tag : str
             The name to store this function under for later retrieval/removal.
             If none is provided, the name of the function will be used. A
             callable object with no name will be called '<Unknown>'.
+        async_exec : bool
+            Whether the target is run on a worker thread instead of being
+            finished before the next event is handled. If none is provided,
+            the FileWatcher's `threaded_events` setting is used.
 
         Raises
         ------
@@ -146,6 +186,15 @@ class FileWatcher:
             events = list(self._event_targets.keys())
         elif type(events) is not list:
             events = [events]
+        else:
+            events = list(events)  # Copy so the caller's list isn't changed
+
+        # Convert inotify event name strings (e.g. "IN_CLOSE_WRITE") to FileEvents
+        for (i, event) in enumerate(events):
+            if isinstance(event, str):
+                if event not in FileEvent._by_value:
+                    raise ValueError("Argument 'events' contains an unknown FileEvent string: {}".format(event))
+                events[i] = FileEvent._by_value[event]
 
         # Validate arguments
         for event in events:
@@ -157,8 +206,10 @@ class FileWatcher:
                 return False
 
         # Add target for each type
+        run_async = self._threaded if async_exec is None else async_exec
         for event in events:
-            self._event_targets[event][tag] = target
+            self._event_targets[event][tag] = (target, run_async)
+        self._build_dispatch()
 
         return True
 
@@ -188,8 +239,19 @@ class FileWatcher:
         if event not in self._event_targets or tag not in self._event_targets[event]:
             return False
         del self._event_targets[event][tag]
+        self._build_dispatch()
         return True
 
+    def _build_dispatch(self) -> None:
+        """
+        Rebuilds the table `listen()` uses to find the targets for an inotify event
+        mask. FileEvents without any targets are left out, so they cost nothing.
+        The tagged dictionaries stay the store for registering targets, while the
+        table holds a tuple of each FileEvent's (target, async) pairs so events can loop over them directly
+        """
+        self._dispatch = tuple((_EVENT_MASKS[event], event, tuple(targets.values()))
+                               for event, targets in self._event_targets.items() if targets)
+
     def listen(self):
         """
         Prints all file events an adapter has seen. Additionally,
@@ -199,31 +261,93 @@ class FileWatcher:
 
         Note: For events where the triggering item is a directory,
         the filename will be an empty string
+
+        The thread sleeps until either inotify has events to read, a held
+        event is due or `stop()` is called, so no time is spent polling while idle
+        """
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.adapter, selectors.EVENT_READ)
+            selector.register(self._wakeup_read, selectors.EVENT_READ)
+            while self._listening:
+                timeout = None
+                if self._pending:  # Wake up when the oldest held event is due
+                    (deadline, _) = next(iter(self._pending.values()))
+                    timeout = max(deadline - time.monotonic(), 0)
+                for (key, _) in selector.select(timeout):
+                    if key.fileobj == self._wakeup_read:  # Clear the wakeup signal sent by `stop()`
+                        os.read(self._wakeup_read, 64)
+                    else:
+                        for inotify_event in self.adapter.read(timeout=0):
+                            self._handle(inotify_event)
+                self._flush_pending(time.monotonic())
+        self._flush_pending()  # Don't drop the events still held when stopped
+
+    def _flush_pending(self, now: float = None) -> None:
         """
-        for item in self.adapter.event_gen():
-            # Break out of generator if SICK_FTP_Test stopped
-            if not self._listening:
+        Calls the targets of held events which are due
+
+        :param now: The `time.monotonic()` value to compare deadlines to. If
+                    none is provided, every held event is flushed
+        """
+        pending = self._pending
+        while pending:
+            (data, (deadline, targets)) = next(iter(pending.items()))
+            if now is not None and deadline > now:  # Events are held in order, so the rest are later
                 break
+            del pending[data]
+            self._call_targets(targets, data)
+
+    def _handle(self, inotify_event) -> None:
+        """
+        Calls the targets for each FileEvent type in an inotify event
 
-            # Ignore None events. They can't be ignored or the generator
-            # will indefinitely block in between file events
-            if item is None:
+        :param inotify_event: The event read from the inotify adapter
+        """
+        (wd, mask, _, filename) = inotify_event
+        path = self._watch_paths.get(wd)
+        if path is None:  # Ignore events from watches which were already removed
+            return
+
+        if mask & flags.IGNORED:  # The watch was removed, e.g. because its directory was deleted
+            self._watched_paths.discard(self._watch_paths.pop(wd))
+        elif self._recursive and mask & flags.CREATE and mask & flags.ISDIR:  # Watch new subdirectories
+            self._add_watch(os.path.join(path, filename))
+
+        for (bit, event, targets) in self._dispatch:
+            if not mask & bit:
                 continue
+            data = (event, filename, path)
+            if not self._coalesce_s:
+                self._call_targets(targets, data)
+            elif data not in self._pending:  # Repeats of a held event are dropped
+                self._pending[data] = (time.monotonic() + self._coalesce_s, targets)
+
+    def _call_targets(self, targets: tuple, data: tuple) -> None:
+        """
+        Calls each target of an event
+
+        :param targets: The (target, async) pairs to call
+        :param data: The (FileEvent, file name, directory) tuple passed to the targets
+        """
+        for (target, run_async) in targets:
+            if run_async:
+                self._pool_slots.acquire()  # If the workers have fallen behind, wait for them to catch up
+                future = self._pool.submit(target, data)
+                future.add_done_callback(_report_exception)
+                future.add_done_callback(self._release_slot)
+            else:  # Finish synchronous targets before continuing
+                try:
+                    target(data)
+                except Exception:
+                    traceback.print_exc()
+
+    def _release_slot(self, future: Future) -> None:
+        """
+        Frees the pool slot of a finished asynchronous target call
 
-            (_, type_names, path, filename) = item
-            for event_name in type_names:
-                event = FileEvent(event_name)
-                self._event_threads = []
-                for tag, target in self._event_targets[event].items():
-                    data = (event, filename, path)
-                    thread = threading.Thread(target=target, args=(data,))
-                    thread.start()
-                    self._event_threads.append(thread)
-                # If event threading is turned off, wait until all
-                # threads have finished to continue
-                if not self._threaded:
-                    for spawned_thr in self._event_threads:
-                        spawned_thr.join()
+        :param future: The future of the finished target call
+        """
+        self._pool_slots.release()
 
     def start(self):
         """
@@ -234,7 +358,16 @@ class FileWatcher:
         """
         if not self._listening:
             self._listening = True
-            self.listen()
+            # Worker threads are only started once an asynchronous target is first called
+            workers = (os.cpu_count() or 1) * 2
+            self._pool = ThreadPoolExecutor(max_workers=workers)
+            self._pool_slots = threading.BoundedSemaphore(workers * _QUEUED_PER_WORKER)
+            try:
+                self.listen()
+            finally:
+                if self._pool is not None:  # Let any running targets finish
+                    self._pool.shutdown(wait=True)
+                    self._pool = None
 
     def is_listening(self):
         """
@@ -253,3 +386,16 @@ class FileWatcher:
         """
         print("Stopping...")
         self._listening = False
+        os.write(self._wakeup_write, b"\0")  # Wake up `listen()` so it sees the change
+
+
+def _report_exception(future: Future) -> None:
+    """
+    Prints the traceback of a target which raised an exception on a worker thread,
+    since the pool would otherwise discard it silently
+
+    :param future: The future of the finished target call
+    """
+    exc = future.exception()
+    if exc is not None:
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
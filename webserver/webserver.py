@@ -8,19 +8,34 @@ status of the links in the chain
 @date 4/11/2020
 """
 
-from datetime import datetime, timedelta
 import importlib
 import json
 import os
+import socket
 from typing import Optional
 
 from flask import Flask
-from flask import jsonify, redirect, render_template, request, send_from_directory, url_for
+from flask import abort, jsonify, make_response, redirect, render_template, request, send_from_directory, url_for
+from jinja2 import FileSystemBytecodeCache
+from werkzeug.security import safe_join
 
 from dbconnection import dbconnection
 from config import Config
 
+# Response compression is optional. If the module is not present, responses are sent uncompressed
+try:
+    from flask_compress import Compress
+except ModuleNotFoundError:
+    Compress = None
+
 app = Flask(__name__)
+
+# Keep compiled templates between restarts, so they only have to be parsed when they change.
+# Jinja's default directory is private to the current user and has its ownership checked
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
+if Compress is not None:
+    Compress(app)
+
 HOSTNAME = '0.0.0.0'  # The hostname for external access
 PORT = None
 
@@ -28,6 +43,18 @@ CONFIG = None                            # The configuration object
 CONFIG_FILE = "config.json"              # The name of the module's configuration file
 MODULE_DIR = os.path.split(__file__)[0]  # The directory of this module
 
+# Values from CONFIG used by the pages. Set by `_cache_config()` whenever the config is loaded
+_ACTIVE_DELAY = None
+_NUM_WORST = None
+_WARNING_THRESHOLD = None
+_MEDIA_FOLDER = None
+_SPEC_FILENAME = None
+_X_ACCEL_PREFIX = ""
+
+_qr_url = None         # The URL encoded in the saved QR code, or `None` if it hasn't been made yet
+_CONFIG_CACHE = {}     # The modification time and `json_to_list()` result of each config file shown on /configure
+_GRID_CACHE = (None, None)  # The ETag of the last rendered /grid page and its HTML
+
 # The list of web pages to appear in the navbar, including their navbar title and URL
 nav_list = [
     {
@@ -47,6 +74,7 @@ nav_list = [
         'location': '/spec'
     },
 ]
+app.jinja_env.globals['nav_list'] = nav_list  # Make the navbar available to every template
 
 
 # =============================================================================================
@@ -55,19 +83,39 @@ nav_list = [
 
 
 def create_qr():
+    global _qr_url
     # If the module is not present, abort silently
     try:
         import qrcode
     except ModuleNotFoundError:
         return
-    # Unfortunately, this is the only way to reliably get the current IP address on a Debian system
-    stream = os.popen('hostname -I')  # Run Linux on
-    ip_addr = stream.read().strip()
+    url = f"http://{_local_ip()}:{PORT}"
+    qr_path = os.path.join(app.root_path, 'static/qr_code.jpg')
+    if url == _qr_url and os.path.exists(qr_path):  # The saved QR code is still correct
+        return
 
     """ Generate QR code and save in static directory """
 
-    qr_img = qrcode.make(f"http://{ip_addr}:{PORT}")
-    qr_img.save(os.path.join(app.root_path, 'static/qr_code.jpg'))
+    qr_img = qrcode.make(url)
+    qr_img.save(qr_path)
+    _qr_url = url
+
+
+def _local_ip() -> str:
+    """
+    Finds the IP address of the network interface used for outgoing traffic.
+    Connecting a UDP socket only selects a route, so no packets are sent
+
+    :return: The IP address, or the loopback address if there is no network
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(('10.255.255.255', 1))
+        return sock.getsockname()[0]
+    except OSError:  # No route is available
+        return '127.0.0.1'
+    finally:
+        sock.close()
 
 
 def error_code(message):
@@ -97,16 +145,31 @@ def json_to_list(config: dict) -> list:
     :param config: The JSON dictionary to convert
     :return: The list of dictionaries
     """
-    attr_list = []
-    for attribute in config:
-        if not attribute.startswith("_"):
-            comment_key = "_comment_" + attribute
-            attr_list.append({
-                "name": attribute,
-                "type": "number" if type(config[attribute]) is int else "text",
-                "value": config[attribute],
-                "comment": config[comment_key] if comment_key in config else None
-            })
+    prefix_len = len("_comment_")
+    comments = {key[prefix_len:]: value for (key, value) in config.items() if key.startswith("_comment_")}
+    return [{
+        "name": attribute,
+        "type": "number" if type(value) is int else "text",
+        "value": value,
+        "comment": comments.get(attribute)
+    } for (attribute, value) in config.items() if not attribute.startswith("_")]
+
+
+def load_config_list(path: str) -> list:
+    """
+    Reads a config file and converts it with `json_to_list()`. The result is
+    cached until the file's modification time changes
+
+    :param path: The path to the config file
+    :return: The list of dictionaries for the file's config values
+    """
+    mtime = os.stat(path).st_mtime_ns
+    cached = _CONFIG_CACHE.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path) as config_file:
+        attr_list = json_to_list(json.load(config_file))
+    _CONFIG_CACHE[path] = (mtime, attr_list)
     return attr_list
 
 
@@ -123,6 +186,21 @@ def load_config():
         "WARNING_THRESHOLD": float,
     }
     CONFIG = Config(f"{MODULE_DIR}/{CONFIG_FILE}", required_keys=required_keys)
+    _cache_config()
+
+
+def _cache_config() -> None:
+    """
+    Copies the config values used by the pages into module variables,
+    so they don't need to be looked up in CONFIG on each request
+    """
+    global _ACTIVE_DELAY, _NUM_WORST, _WARNING_THRESHOLD, _MEDIA_FOLDER, _SPEC_FILENAME, _X_ACCEL_PREFIX
+    _ACTIVE_DELAY = CONFIG['ACTIVE_DELAY']
+    _NUM_WORST = CONFIG['NUM_WORST']
+    _WARNING_THRESHOLD = CONFIG['WARNING_THRESHOLD']
+    _MEDIA_FOLDER = CONFIG['MEDIA_FOLDER']
+    _SPEC_FILENAME = CONFIG['SPEC_FILENAME']
+    _X_ACCEL_PREFIX = CONFIG['X_ACCEL_PREFIX'] if 'X_ACCEL_PREFIX' in CONFIG else ""
 
 
 def package_to_config(package: str) -> Optional[str]:
@@ -160,10 +238,13 @@ def index():
     """
     overview = {}
 
+    # Gather every statistic on the page in one call to the database
+    stats = dbconnection.get_index_overview(_NUM_WORST, _WARNING_THRESHOLD, _ACTIVE_DELAY)
+
     # The number of links
-    link_count = dbconnection.count_links()
+    link_count = stats['link_count']
     overview['link_count'] = link_count
-    image_count = dbconnection.count_images()
+    image_count = stats['image_count']
     overview['image_count'] = image_count
 
     """ Check the chain status """
@@ -177,14 +258,13 @@ def index():
         overview['active'] = False
         overview['offline_dur'] = 'N/A'
     else:
-        overview['most_recent'] = dbconnection.get_most_recent_image()
+        overview['most_recent'] = stats['most_recent']
 
         # See if line is active, i.e. has inspected a chain within a given time frame
         # If inactive, calculate create a string representing the time the system has been offline
-        time_elapsed = datetime.now() - overview['most_recent']['time']
-        overview['active'] = time_elapsed < timedelta(seconds=CONFIG['ACTIVE_DELAY'])
+        overview['active'] = stats['active']
         if not overview['active']:
-            days, remainder = divmod(int(time_elapsed.total_seconds()), 86400)
+            days, remainder = divmod(stats['seconds_elapsed'], 86400)
             hours, remainder = divmod(remainder, 3600)
             minutes, seconds = divmod(remainder, 60)
             if days > 0:
@@ -195,32 +275,23 @@ def index():
     if link_count == 0:
         overview['no_match_str'] = "N/A"
     else:
-        no_match = dbconnection.count_no_match()
+        no_match = stats['no_match']
         no_match_perc = round(100 * no_match / image_count, 2)
-        overview['no_match_str'] = "0 (0%)" if no_match is None else f"{no_match} ({no_match_perc}%)"
+        overview['no_match_str'] = f"{no_match} ({no_match_perc}%)"
 
     """ List the links with the worst pass rate """
-    worst_links = dbconnection.find_worst_links(CONFIG['NUM_WORST'])
-    worst_link_list = []
-    for link in worst_links:
-        link_dict = {
-            "link_id": link[0],
-            "pass_rate": "%.2f%%" % (link[1] * 100)  # Convert ratio to string with percentage
-        }
-        worst_link_list.append(link_dict)
-    overview['worst'] = worst_link_list
+    overview['worst'] = stats['worst']  # The (link id, pass rate percentage) rows are formatted by the template
 
     """ Calculate the number/percentage of links whose pass rate is below a certain threshold """
     if link_count == 0:
         overview['at_risk_str'] = "N/A"
     else:
-        at_risk_count = dbconnection.count_at_risk(threshold=CONFIG['WARNING_THRESHOLD'])
+        at_risk_count = stats['at_risk']
         risk_perc = round(100 * at_risk_count / link_count, 2)
         overview['at_risk_str'] = f"{at_risk_count} ({risk_perc}%)"
 
     return render_template('index.html',
                            curr_page='Home',
-                           nav_list=nav_list,
                            title="Home",
                            overview=overview)
 
@@ -228,28 +299,34 @@ def index():
 @app.route('/grid')
 def grid():
     """
-    A page displaying all of the links in a large grid, color coded based on their failure rates
-    """
-    title = "List of links in collection"
-    link_list = []
-    for link_id, pass_rate in dbconnection.get_pass_rates().items():
-        weighted_pass_rate = pass_rate ** 2                   # Adjust pass_rate to inflate lower scores
-        blue_val = int(255 * weighted_pass_rate)              # Calculate blue component of color
-        red_val = int(255 * (1 - weighted_pass_rate))         # Calculate red component of color
-        hex_string = "#%0.6X" % ((red_val << 16) + blue_val)  # Convert to hex color code
-        link_data = {
-            "style": f"background-color: {hex_string}; color: white",
+    A page displaying all of the links in a large grid, color coded based on their failure rates.
+    The page only changes when images are added or removed, so it is identified by an ETag of
+    the images table's version. Browsers with the current page get an empty 304 response, and
+    the rendered page is reused for everyone else until the table changes
+    """
+    global _GRID_CACHE
+    tag = dbconnection.get_images_version()
+    if request.if_none_match.contains(tag):  # The browser already has the current page
+        response = make_response('', 304)
+        response.set_etag(tag)
+        return response
+    (cached_tag, html) = _GRID_CACHE
+    if cached_tag != tag:  # Render the page again if the images have changed
+        title = "List of links in collection"
+        # The links arrive sorted by id, with their pass rates as percentages and their colors
+        link_list = [{
+            "style": f"background-color: {color}; color: white",
             "link_id": link_id,
             "pass_rate": pass_rate
-        }
-        link_data['pass_rate'] = round(link_data['pass_rate'] * 100, 3)  # Convert ratio to %
-        link_list.append(link_data)
-    link_list.sort(key=lambda i: i['link_id'])
-    return render_template('grid.html',
-                           curr_page='Status Grid',
-                           nav_list=nav_list,
-                           title=title,
-                           link_list=link_list)
+        } for (link_id, pass_rate, color) in dbconnection.get_pass_rates_sorted()]
+        html = render_template('grid.html',
+                               curr_page='Status Grid',
+                               title=title,
+                               link_list=link_list)
+        _GRID_CACHE = (tag, html)
+    response = make_response(html)
+    response.set_etag(tag)
+    return response
 
 
 @app.route('/<int:link_id>')
@@ -273,19 +350,15 @@ def link_page(link_id: int):
     """ Gather recent images and group by camera """
 
     for image in link['image_list']:
-        if image["passed"] is None:
-            result = "No Match"
-        else:
-            image["passed"] = bool(image["passed"])
-            result = "Pass" if image['passed'] else "Failed"
+        passed = image["passed"]
         img_data = {
             "id": image["img_id"],
-            "date": image["time"].strftime('%Y-%m-%d'),
-            "file": os.path.basename(image["filepath"]),
+            "date": image["date_str"],
+            "file": image["file"],
             "loop": image["loop_count"],
-            "passed": image["passed"],
-            "result": result,
-            "time": image["time"].strftime('%H:%M:%S'),
+            "passed": passed,
+            "result": "No Match" if passed is None else ("Pass" if passed else "Failed"),
+            "time": image["time_str"],
             "timestamp": image["time"]  # Leave time stamp intact for sorting
         }
         if image["left_camera"]:
@@ -296,21 +369,16 @@ def link_page(link_id: int):
     """ Gather past failures """
 
     for image in link['past_failures']:
-        if image["passed"] is None:
-            result = "No Match"
-        else:
-            image["passed"] = bool(image["passed"])
-            result = "Pass" if image['passed'] else "Failed"
-        image["left_camera"] = bool(image["left_camera"])
+        passed = image["passed"]
         img_data = {
             "id": image["img_id"],
             "camera": "Left" if image["left_camera"] else "Right",
-            "date": image["time"].strftime('%Y-%m-%d'),
-            "file": os.path.basename(image["filepath"]),
+            "date": image["date_str"],
+            "file": image["file"],
             "loop": image["loop_count"],
-            "passed": image["passed"],
-            "result": result,
-            "time": image["time"].strftime('%H:%M:%S'),
+            "passed": passed,
+            "result": "No Match" if passed is None else ("Pass" if passed else "Failed"),
+            "time": image["time_str"],
             "timestamp": image["time"]  # Leave time stamp intact for sorting
         }
         past_failure_list.append(img_data)
@@ -318,12 +386,12 @@ def link_page(link_id: int):
     """ Compile link overview """
 
     # Check if the most recent images on either the left or right were a failure or no match
-    if len(left_image_list) == 0 and len(right_image_list) == 0:
+    if link['last_time'] is None:
         # Set last result to `None` if there are no images
         last_result = "N/A"
     else:
-        pass_left = left_image_list[0]['passed'] if len(left_image_list) > 0 else None
-        pass_right = right_image_list[0]['passed'] if len(right_image_list) > 0 else None
+        pass_left = link['last_left_passed']
+        pass_right = link['last_right_passed']
         if pass_left is None and pass_right is None:            # Both cameras have no match
             last_result = None
         elif pass_left is not None and pass_right is not None:  # Combine both valid inspections
@@ -332,8 +400,8 @@ def link_page(link_id: int):
             last_result = pass_left if pass_left is not None else pass_right
 
     # Get the timestamp of the most recent link inspection, or 'N/A' if no links inspected
-    if len(link['image_list']) > 0:
-        last_checked = link['image_list'][0]["time"].strftime('%H:%M - %m/%d/%Y')
+    if link['last_time'] is not None:
+        last_checked = link['last_time'].strftime('%H:%M - %m/%d/%Y')
     else:
         last_checked = "N/A"
 
@@ -341,12 +409,11 @@ def link_page(link_id: int):
         "id": link_id,
         "last_checked": last_checked,
         "last_result": last_result,
-        "pass_rate": "%.2f%%" % (link['pass_rate'] * 100)
+        "pass_rate": "%.2f%%" % (link['pass_rate'] * 100) if link['pass_rate'] is not None else "N/A"
     }
 
     return render_template('link.html',
                            curr_page=None,
-                           nav_list=nav_list,
                            title=title,
                            link=link_data,
                            left_image_list=left_image_list,
@@ -364,29 +431,30 @@ def configure():
     if request.method == "POST":
         config_file = package_to_config(request.form['_package'])  # Load the module's config values
         config = Config(config_file, autosave=False)
+        # The types are taken from the list the page was rendered from, which is already cached
+        casters = {item['name']: int if item['type'] == "number" else str for item in load_config_list(config_file)}
+        changed = False
         for (key, value) in request.form.items():  # Update key values
-            # Cast each value to the type it originally was
-            if key in config and type(config[key]) is int:
-                config.set_value(key, int(value))
-            else:
-                config.set_value(key, value)
-        config.save()  # Save new config values
-        if request.form["_package"] == "webserver":  # Reload webserver's config if altered
-            CONFIG.reload()
+            value = casters.get(key, str)(value)  # Cast each value to the type it originally was
+            if key in config and config[key] == value:  # Skip values which weren't changed
+                continue
+            config.set_value(key, value)
+            changed = True
+        if changed:  # Only write the file if something was changed
+            config.save()  # Save new config values
+            _CONFIG_CACHE.pop(config_file, None)  # Don't show the old values if the modification time didn't change
+            if request.form["_package"] == "webserver":  # Reload webserver's config if altered
+                CONFIG.reload()
+                _cache_config()
         return redirect('/configure')
 
     """ Get filewatcher config file """
-    with open(package_to_config("filewatcher")) as config_file:
-        filewatcher_json = json.load(config_file)
-        filewatcher = json_to_list(filewatcher_json)
+    filewatcher = load_config_list(package_to_config("filewatcher"))
     """ Get webserver config file """
-    with open(f"{MODULE_DIR}/{CONFIG_FILE}") as config_file:
-        webserver_json = json.load(config_file)
-        webserver = json_to_list(webserver_json)
+    webserver = load_config_list(f"{MODULE_DIR}/{CONFIG_FILE}")
 
     return render_template('configure.html',
                            curr_page='Configure',
-                           nav_list=nav_list,
                            filewatcher=filewatcher,
                            webserver=webserver,
                            title='Configure')
@@ -395,48 +463,91 @@ def configure():
 @app.route('/spec')
 def documentation():
     # Provides a PDF of the ChainWatch documentation
-    return app.send_static_file(CONFIG['SPEC_FILENAME'])
+    return app.send_static_file(_SPEC_FILENAME)
 
 
 # ----------------------- Hidden pages
 
+def _api_delete_image(param: Optional[str], past_failure: bool = False):
+    """
+    API action which deletes an image
+
+    :param param: The id of the image
+    :param past_failure: Whether the image is in the past_failures table rather than images
+    :return: An error response if the id is invalid, otherwise `None`
+    """
+    if param is None:
+        return error_code(f"No image id provided")
+    try:
+        img_id = int(param)
+    except ValueError:
+        return error_code(f"'{param}' is not a valid integer")
+    dbconnection.delete_image(img_id, past_failure=past_failure)
+    print(f"Deleted image {img_id}")
+
+
+def _api_reset_db(param: Optional[str]) -> None:
+    """
+    API action which removes every image from the database
+
+    :param param: Unused
+    """
+    dbconnection.clear_img_database()
+    print("Database cleared")
+
+
+def _api_reset_link(param: Optional[str]):
+    """
+    API action which removes every image of a link from the database
+
+    :param param: The id of the link
+    :return: An error response if the id is invalid, otherwise `None`
+    """
+    if not param:
+        return error_code("No link id specified")
+    try:
+        link_id = int(param)
+    except ValueError:
+        return error_code(f"'{param}' is not a valid integer")
+    dbconnection.clear_img_database(link_id)
+
+
+def _api_restart_server(param: Optional[str]) -> None:
+    """
+    API action which immediately kills the app without responding
+
+    :param param: Unused
+    """
+    print('Killing server...')
+    func = request.environ.get('werkzeug.server.shutdown')
+    if func is None:
+        raise RuntimeError('Not running with the Werkzeug Server')
+    func()
+
+
+# The function for each API action. Each is passed the request's 'param' value, and returns
+# an error response if the request was invalid or `None` if the action succeeded
+_API_ACTIONS = {
+    'deleteImg': _api_delete_image,
+    'deleteFailure': lambda param: _api_delete_image(param, past_failure=True),
+    'resetDB': _api_reset_db,
+    'resetLink': _api_reset_link,
+    'restartServer': _api_restart_server,
+    'updateQR': lambda param: create_qr(),
+}
+
+
 @app.route('/api', methods=['GET'])
 def api():
     action = request.args.get('action')
-    param = request.args.get('param')
     if action is None:
         return error_code("No 'action' provided")
-    elif action in ['deleteImg', 'deleteFailure']:
-        if param is None:
-            return error_code(f"No image id provided")
-        try:
-            param = int(param)
-        except ValueError:
-            error_code(f"'{param}' is not a valid integer")
-        dbconnection.delete_image(param, past_failure=(action == 'deleteFailure'))
-        print(f"Deleted image {param}")
-    elif action == 'resetDB':
-        dbconnection.clear_img_database()
-        print("Database cleared")
-    elif action == 'resetLink':
-        if not param:
-            return error_code("No link id specified")
-        try:
-            param = int(param)
-        except ValueError:
-            error_code(f"'{param}' is not a valid integer")
-        dbconnection.clear_img_database(param)
-    elif action == 'restartServer':
-        # Immediately kills the app without responding
-        print('Killing server...')
-        func = request.environ.get('werkzeug.server.shutdown')
-        if func is None:
-            raise RuntimeError('Not running with the Werkzeug Server')
-        func()
-    elif action == 'updateQR':
-        create_qr()
-    else:
+    handler = _API_ACTIONS.get(action)
+    if handler is None:
         return error_code(f"The action '{action}' is not supported")
+    error = handler(request.args.get('param'))
+    if error is not None:  # The action was rejected
+        return error
     return jsonify({
         "status": "ok",
         "code": 200
@@ -446,7 +557,15 @@ def api():
 @app.route('/imgs/<path:filename>')
 def imgs(filename):
     # The endpoint for accessing the link images
-    return send_from_directory(CONFIG['MEDIA_FOLDER'], filename)
+    if _X_ACCEL_PREFIX:  # Let nginx send the file from its internal location for the media folder
+        location = safe_join(_X_ACCEL_PREFIX, filename)
+        if location is None:  # Reject paths outside of the media folder
+            abort(404)
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = location
+        del response.headers['Content-Type']  # Let nginx set the type from the file
+        return response
+    return send_from_directory(_MEDIA_FOLDER, filename, conditional=True)
 
 
 @app.route('/slideshow/<int:link_id>')
@@ -463,13 +582,12 @@ def slideshow(link_id: int):
     """ Gather recent images and group by camera """
 
     for image in link['image_list']:
-        image["passed"] = bool(image["passed"])
         img_data = {
-            "date": image["time"].strftime('%Y-%m-%d'),
-            "file": os.path.basename(image["filepath"]),
+            "date": image["date_str"],
+            "file": image["file"],
             "loop": image["loop_count"],
-            "passed": image["passed"],
-            "time": image["time"].strftime('%H:%M:%S'),
+            "passed": bool(image["passed"]),
+            "time": image["time_str"],
         }
         if image["left_camera"]:
             left_image_list.append(img_data)
@@ -477,7 +595,6 @@ def slideshow(link_id: int):
             right_image_list.append(img_data)
 
     return render_template('slideshow.html',
-                           nav_list=nav_list,
                            title=title,
                            left_images=left_image_list,
                            right_images=right_image_list)
@@ -500,6 +617,8 @@ def start(port: int = None):
     global app, HOSTNAME, PORT
     load_config()
     PORT = CONFIG['PORT'] if port is None else port
+    # Have the proxy server send files through the X-Sendfile header instead of reading them in Python
+    app.use_x_sendfile = 'USE_X_SENDFILE' in CONFIG and bool(CONFIG['USE_X_SENDFILE'])
     create_qr()
     app.run(host=HOSTNAME, port=PORT)
 